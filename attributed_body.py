@@ -0,0 +1,83 @@
+from collections import OrderedDict
+
+# On newer macOS, message.text is often NULL and the text only lives in the
+# attributedBody column, an NSAttributedString archived as a typedstream.
+# The plain text is the first NSString in the stream:
+#   ... "NSString" <class info> '+' <length> <utf-8 bytes> ...
+
+LRU_SIZE = 2048  # Decoded texts kept, keyed by (ROWID, date_edited)
+HEADER_SCAN = 512  # The NSString class name sits in the first few dozen bytes
+_CLASS_MARKER = b"NSString"
+_STRING_MARKER = 0x2B  # '+'
+_MAX_MARKER_GAP = 16   # '+' is a few bytes after the class name
+
+_cache = OrderedDict()
+
+def extract_text(blob):
+    """Pull the plain text out of an attributedBody blob (bytes or memoryview).
+
+    Only the header and the final text are copied out of the blob.
+    Returns None if the blob doesn't look like a typedstream string.
+    """
+    if not blob:
+        return None
+    buf = memoryview(blob)
+
+    idx = bytes(buf[:HEADER_SCAN]).find(_CLASS_MARKER)
+    if idx < 0:
+        return None
+
+    pos = idx + len(_CLASS_MARKER)
+    end = min(pos + _MAX_MARKER_GAP, len(buf))
+    while pos < end and buf[pos] != _STRING_MARKER:
+        pos += 1
+    if pos >= end:
+        return None
+    pos += 1
+
+    # Length: one byte, or 0x81 + uint16 / 0x82 + uint32 (little endian)
+    if pos >= len(buf):
+        return None
+    length = buf[pos]
+    pos += 1
+    if length == 0x81:
+        length = int.from_bytes(buf[pos:pos + 2], 'little')
+        pos += 2
+    elif length == 0x82:
+        length = int.from_bytes(buf[pos:pos + 4], 'little')
+        pos += 4
+
+    if pos + length > len(buf):
+        return None
+    return str(buf[pos:pos + length], 'utf-8', errors='replace')
+
+def get_text(rowid, text, blob, date_edited=0):
+    """Return the message text, decoding attributedBody (with an LRU) when text is NULL.
+
+    Edited messages keep their ROWID but get a new attributedBody and
+    date_edited, so the cache is keyed on both. Failed decodes aren't cached.
+    """
+    if text:
+        return text
+    if not blob:
+        return None
+
+    key = (rowid, date_edited or 0)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    decoded = extract_text(blob)
+    if decoded is None:
+        return None
+    _cache[key] = decoded
+    if len(_cache) > LRU_SIZE:
+        _cache.popitem(last=False)
+    return decoded
+
+def decode_rows(rows):
+    """Decode a batch of (rowid, text, attributedBody, date_edited, *rest) rows.
+
+    Returns (rowid, text, *rest) with text filled in from attributedBody where needed.
+    """
+    return [(row[0], get_text(row[0], row[1], row[2], row[3])) + tuple(row[4:]) for row in rows]
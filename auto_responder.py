@@ -5,8 +5,17 @@ import time
 import sqlite3
 import os
 
+import attributed_body
+import best_of_n
+import context_builder
+import latency
+from state_store import StateStore, STATE_DB_FILE
+
 RESPONSE_CACHE_FILE = "response_cache.json"
 MAX_CACHE_SIZE = 50  # Keep last 50 responses
+APPLE_EPOCH = 978307200  # chat.db dates are nanoseconds since 2001-01-01
+DEFAULT_BACKLOG_POLICY = "last"     # "last", "coalesce" or "each"
+DEFAULT_BACKLOG_MAX_AGE_MINUTES = 60
 
 def load_response_cache():
     """Load previous responses from cache file."""
@@ -42,7 +51,7 @@ def get_recent_phrases():
     cache = load_response_cache()
     return cache[-10:]  # Return last 10 responses for context
 
-def generate_admin_response(model, url, command):
+def generate_admin_response(model, url, command, queue_depth=0):
     """Generate a response for admin commands with @LLM prefix."""
     
     print(f"  🔄 Loading personality for admin...")
@@ -52,22 +61,27 @@ def generate_admin_response(model, url, command):
 
     prompt = f"{admin_prompt}\n\nAdmin command: \"{command}\"\n\nYour response:"
 
+    timeout, options = latency.request_budget(model, url, "admin", 30, queue_depth, personalities.get('length_targets'))
     data = {
         "model": model,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "options": options
     }
     print(f"  🧠 Sending admin command to LLM...")
     try:
-        response = requests.post(url, json=data, timeout=30)
+        started = time.time()
+        response = requests.post(url, json=data, timeout=timeout)
         response.raise_for_status()
+        latency.record(model, url, time.time() - started)
         print(f"  ✓ LLM responded successfully")
         message = response.json()['response'].strip()
         if message.startswith('"') and message.endswith('"'):
             message = message[1:-1]
         return message
     except requests.exceptions.Timeout:
-        error_msg = "LLM request timed out (30s)"
+        latency.record(model, url, timeout[1])
+        error_msg = f"LLM request timed out ({timeout[1]:.0f}s)"
         print(f"  ❌ {error_msg}")
         return f"Error: {error_msg}"
     except requests.exceptions.ConnectionError:
@@ -91,8 +105,77 @@ def load_personality():
     with open('personality.json', 'r') as f:
         return json.load(f)
 
-def generate_response(model, url, incoming_message, sender_name=None):
-    """Generate a response to an incoming message with a fun personality."""
+def build_response_prompt(personality, incoming_message, recent, context=""):
+    """Build the reply prompt for the girlfriend persona."""
+    avoid_text = ""
+    if recent:
+        avoid_text = f"\n\nCRITICAL - DO NOT repeat these phrases or patterns from recent messages: {recent}\nUse DIFFERENT words, reactions, and sentence structures!"
+    
+    context_text = f"\n\n{context}" if context else ""
+
+    return f"DONT SAY MAN OR GIRL TERMS. YOU ARE TALKING TO MY GIRLFIEND. NEVER ASK QUESTIONS - ONLY STATEMENTS! {personality}{avoid_text}{context_text}\n\nThey sent: \"{incoming_message}\"\n\nYour response (STATEMENT ONLY, NO QUESTIONS):"
+
+def fit_fixed_prompt(personality, incoming_message, recent, max_tokens):
+    """Trim the avoid-list (oldest first), then the personality, until the prompt fits max_tokens.
+
+    The incoming message is never cut. If it alone overflows the budget the
+    prompt is sent as is, and there's no room left for context.
+    Returns (personality, recent).
+    """
+    recent = list(recent)
+
+    def estimate():
+        return context_builder.estimate_tokens(build_response_prompt(personality, incoming_message, recent))
+
+    while recent and estimate() > max_tokens:
+        recent.pop(0)
+    overflow = estimate() - max_tokens
+    if overflow > 0:
+        personality = personality[:max(0, len(personality) - overflow * 4)]
+        if estimate() > max_tokens:
+            print(f"  ⚠️  Incoming message alone is over the {max_tokens} token prompt budget, sending without context")
+    return personality, recent
+
+def assemble_response_prompt(model, url, personality, incoming_message, recent, max_prompt_tokens,
+                             context_phone=None, exclude_rowid=None,
+                             history_turns=context_builder.DEFAULT_HISTORY_TURNS,
+                             db_path=None, before_rowid=None, summary_history=None):
+    """Build the full reply prompt within max_prompt_tokens. Returns (prompt, recent).
+
+    The fixed parts are fitted first and the conversation context gets what's
+    left. Shared by generate_response and replay.py, which passes db_path,
+    before_rowid and summary_history to rebuild past context.
+    """
+    personality, recent = fit_fixed_prompt(personality, incoming_message, recent, max_prompt_tokens)
+    context = ""
+    if context_phone:
+        fixed_tokens = context_builder.estimate_tokens(build_response_prompt(personality, incoming_message, recent))
+        context = context_builder.build_context(
+            model,
+            url,
+            context_phone,
+            exclude_rowid=exclude_rowid,
+            history_turns=history_turns,
+            max_tokens=max_prompt_tokens - fixed_tokens - 1,  # -1 for the blank line before the context
+            db_path=db_path,
+            before_rowid=before_rowid,
+            summary_history=summary_history
+        )
+    return build_response_prompt(personality, incoming_message, recent, context), recent
+
+def generate_response(model, url, incoming_message, sender_name=None, context_phone=None, exclude_rowid=None,
+                      history_turns=context_builder.DEFAULT_HISTORY_TURNS,
+                      max_prompt_tokens=context_builder.DEFAULT_MAX_CONTEXT_TOKENS, queue_depth=0,
+                      best_of=best_of_n.DEFAULT_CANDIDATES, deadline=best_of_n.DEFAULT_DEADLINE_SECONDS):
+    """Generate a response to an incoming message with a fun personality.
+
+    With context_phone set, the conversation thread is added to the prompt.
+    The whole prompt stays within max_prompt_tokens: the context only gets
+    what the personality, avoid-list and message leave over.
+
+    With best_of > 1, several candidates are generated at once and the best
+    one by the persona rules is used (see best_of_n.generate_best).
+    """
     
     print(f"  🔄 Loading personality...")
     personalities = load_personality()
@@ -102,31 +185,44 @@ def generate_response(model, url, incoming_message, sender_name=None):
     # Get recent responses to avoid repetition
     print(f"  📚 Checking response cache...")
     recent = get_recent_phrases()
-    avoid_text = ""
     if recent:
         print(f"  ⚠️  Avoiding {len(recent)} recent phrases")
-        avoid_text = f"\n\nCRITICAL - DO NOT repeat these phrases or patterns from recent messages: {recent}\nUse DIFFERENT words, reactions, and sentence structures!"
     
-    prompt = f"DONT SAY MAN OR GIRL TERMS. YOU ARE TALKING TO MY GIRLFIEND. NEVER ASK QUESTIONS - ONLY STATEMENTS! {personality}{avoid_text}\n\nThey sent: \"{incoming_message}\"\n\nYour response (STATEMENT ONLY, NO QUESTIONS):"
+    if context_phone:
+        print(f"  🧵 Building conversation context...")
+    prompt, recent = assemble_response_prompt(model, url, personality, incoming_message, recent, max_prompt_tokens,
+                                              context_phone, exclude_rowid, history_turns)
 
+    pool = latency.BEST_OF_POOL if best_of > 1 else latency.SINGLE_POOL
+    timeout, options = latency.request_budget(model, url, "girlfriend", 30, queue_depth,
+                                              personalities.get('length_targets'), pool)
     data = {
         "model": model,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "options": options
     }
     print(f"  🧠 Sending to LLM (model: {model})...")
     try:
-        response = requests.post(url, json=data, timeout=30)
-        response.raise_for_status()
+        if best_of > 1:
+            print(f"  🎲 Generating {best_of} candidates (deadline {deadline}s)...")
+            length_words = latency.length_target("girlfriend", personalities.get('length_targets'))
+            message = best_of_n.generate_best(model, url, prompt, recent, best_of, deadline, options, timeout, length_words)
+        else:
+            started = time.time()
+            response = requests.post(url, json=data, timeout=timeout)
+            response.raise_for_status()
+            latency.record(model, url, time.time() - started)
+            message = response.json()['response'].strip()
+            # Remove surrounding quotes if present
+            if message.startswith('"') and message.endswith('"'):
+                message = message[1:-1]
         print(f"  ✓ LLM responded successfully")
-        message = response.json()['response'].strip()
-        # Remove surrounding quotes if present
-        if message.startswith('"') and message.endswith('"'):
-            message = message[1:-1]
         print(f"  📝 Generated response: {message}")
         return message
     except requests.exceptions.Timeout:
-        error_msg = "LLM request timed out (30s)"
+        latency.record(model, url, timeout[1], pool)
+        error_msg = f"LLM request timed out ({timeout[1]:.0f}s)"
         print(f"  ❌ {error_msg}")
         return "holdd one one sec, busy!! 💕"
     except requests.exceptions.ConnectionError:
@@ -206,7 +302,7 @@ def get_last_message(phone, include_from_me=False):
         phone_digits = ''.join(filter(str.isdigit, phone))
         
         query = """
-        SELECT m.rowid, m.text, m.is_from_me, m.date
+        SELECT m.rowid, m.text, m.attributedBody, m.date_edited, m.is_from_me, m.date
         FROM message m
         JOIN handle h ON m.handle_id = h.rowid
         WHERE h.id LIKE ?
@@ -219,7 +315,9 @@ def get_last_message(phone, include_from_me=False):
         conn.close()
         
         if row:
-            rowid, text, is_from_me, date = row
+            rowid, text, body_blob, date_edited, is_from_me, date = row
+            # text is NULL on newer macOS, the content is only in attributedBody
+            text = attributed_body.get_text(rowid, text, body_blob, date_edited)
             # For admin: return any message (we'll check @LLM prefix)
             # For girlfriend: only return if it's FROM her (is_from_me=0)
             if include_from_me:
@@ -236,10 +334,84 @@ def get_last_message(phone, include_from_me=False):
             return (False, None, None, None)
         return (False, None, None)
 
+def get_messages_since(phone, since_rowid):
+    """Get every message with this number newer than since_rowid, oldest first.
+
+    Returns a list of (rowid, guid, text, is_from_me, unix_time, associated_type).
+    """
+    db_path = os.path.expanduser("~/Library/Messages/chat.db")
+    
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        
+        phone_digits = ''.join(filter(str.isdigit, phone))
+        
+        query = """
+        SELECT m.rowid, m.text, m.attributedBody, m.date_edited, m.guid, m.is_from_me, m.date, m.associated_message_type
+        FROM message m
+        JOIN handle h ON m.handle_id = h.rowid
+        WHERE h.id LIKE ? AND m.rowid > ?
+        ORDER BY m.rowid
+        """
+        
+        cursor.execute(query, (f"%{phone_digits[-10:]}%", since_rowid))
+        rows = attributed_body.decode_rows(cursor.fetchall())
+        conn.close()
+        
+        return [(rowid, guid, text, is_from_me, date / 1e9 + APPLE_EPOCH, associated_type)
+                for rowid, text, guid, is_from_me, date, associated_type in rows]
+    except Exception as e:
+        print(f"Error reading Messages database: {e}")
+        return []
+
+def classify_message(text, associated_type):
+    """Decide whether an incoming message gets a reply: "reply", "tapback" or "empty".
+
+    Tapbacks ("Loved ...") and other reactions have a non-zero associated_message_type.
+    """
+    if associated_type:
+        return "tapback"
+    if not text or not text.strip():
+        return "empty"
+    return "reply"
+
+def split_answered(messages):
+    """Split get_messages_since rows into (unanswered, answered) incoming messages.
+
+    An incoming message followed by one of mine was already answered, by hand
+    or before a restart, so only incoming messages after my last one count.
+    """
+    last_sent = max((m[0] for m in messages if m[3] == 1), default=0)
+    incoming = [m for m in messages if m[3] == 0]
+    return [m for m in incoming if m[0] > last_sent], [m for m in incoming if m[0] < last_sent]
+
+def plan_replies(messages, policy, max_age_minutes, now):
+    """Decide which incoming messages get a reply after a gap (restart or burst).
+
+    Returns (replies, skipped): replies is a list of (body, covered_messages),
+    skipped are messages that won't be answered.
+    """
+    cutoff = now - max_age_minutes * 60
+    fresh = [m for m in messages if m[4] >= cutoff]
+    skipped = [m for m in messages if m[4] < cutoff]
+    if not fresh:
+        return [], skipped
+
+    if policy == "coalesce":
+        # One reply to everything that was missed
+        return [("\n".join(m[2] for m in fresh), fresh)], skipped
+    if policy == "each":
+        return [(m[2], [m]) for m in fresh], skipped
+    # "last": only answer the newest message
+    return [(fresh[-1][2], [fresh[-1]])], skipped + fresh[:-1]
+
 def check_ollama(model, url):
     """Verify Ollama is running and model exists."""
     try:
-        response = requests.post(url, json={"model": model, "prompt": "hi", "stream": False}, timeout=15)
+        # Same num_ctx as real requests so the model isn't reloaded on the first reply
+        data = {"model": model, "prompt": "hi", "stream": False, "options": {"num_ctx": latency.num_ctx_for(model)}}
+        response = requests.post(url, json=data, timeout=15)
         response.raise_for_status()
         return True, None
     except requests.exceptions.HTTPError:
@@ -251,6 +423,7 @@ def check_ollama(model, url):
 
 def main():
     config = load_config()
+    latency.configure(config)
     
     # The number to listen for messages FROM (your girlfriend)
     listen_from = config['listen_from']
@@ -278,11 +451,27 @@ def main():
     print("\n" + "-" * 55)
     print("Waiting for messages... (Ctrl+C to stop)\n")
     
-    # Get initial state
-    _, _, last_rowid = get_last_message(listen_from)
+    # Get initial state - resume from the saved watermarks if we have them
+    store = StateStore(config.get('state_db', STATE_DB_FILE))
+    backlog_policy = config.get('backlog_policy', DEFAULT_BACKLOG_POLICY)
+    backlog_max_age = config.get('backlog_max_age_minutes', DEFAULT_BACKLOG_MAX_AGE_MINUTES)
+    
+    last_rowid = store.get_watermark('listen')
+    if last_rowid is None:
+        _, _, last_rowid = get_last_message(listen_from)
+        last_rowid = last_rowid or 0
+        store.set_watermark('listen', last_rowid)
+    else:
+        print(f"  ⏪ Catching up from message ID {last_rowid} (policy: {backlog_policy}, max age: {backlog_max_age} min)")
+    
     last_admin_rowid = None
     if admin_number:
-        _, _, last_admin_rowid, _ = get_last_message(admin_number, include_from_me=True)
+        last_admin_rowid = store.get_watermark('admin')
+        if last_admin_rowid is None:
+            _, _, last_admin_rowid, _ = get_last_message(admin_number, include_from_me=True)
+            last_admin_rowid = last_admin_rowid or 0
+            store.set_watermark('admin', last_admin_rowid)
+    store.flush()
     
     poll_count = 0
     while True:
@@ -291,57 +480,93 @@ def main():
             print(f"  🔍 Still listening... (checked {poll_count} times)")
         
         # Check girlfriend's messages
-        is_incoming, body, rowid = get_last_message(listen_from)
+        messages = get_messages_since(listen_from, last_rowid)
+        unanswered, answered = split_answered(messages)
+        for m in answered:
+            if not store.is_handled(m[0], m[1]):
+                print(f"  ✓ Already answered message {m[0]}")
+                store.mark_processed(m[0], m[1], 'listen')
+        incoming = [m for m in unanswered
+                    if classify_message(m[2], m[5]) == "reply" and not store.is_handled(m[0], m[1])]
+        replies, skipped = plan_replies(incoming, backlog_policy, backlog_max_age, time.time())
+        
+        for m in skipped:
+            print(f"  ⏭️  Skipping message {m[0]}: {m[2][:50]}...")
+            store.mark_processed(m[0], m[1], 'listen')
         
-        # New incoming message from girlfriend
-        if is_incoming and body and rowid != last_rowid:
+        # New incoming message(s) from girlfriend
+        for i, (body, covered) in enumerate(replies):
+            rowid = covered[-1][0]
             print(f"\n💬 [{listen_from}] says: {body}")
             print(f"  📊 Message ID: {rowid}")
             
             response = generate_response(
                 config['ollama_model'], 
                 config['ollama_url'], 
-                body
+                body,
+                context_phone=listen_from,
+                exclude_rowid=rowid,
+                history_turns=config.get('history_turns', context_builder.DEFAULT_HISTORY_TURNS),
+                max_prompt_tokens=config.get('max_context_tokens', context_builder.DEFAULT_MAX_CONTEXT_TOKENS),
+                queue_depth=len(replies) - i - 1,
+                best_of=config.get('best_of_n', best_of_n.DEFAULT_CANDIDATES),
+                deadline=config.get('best_of_deadline_seconds', best_of_n.DEFAULT_DEADLINE_SECONDS)
             )
             
             print(f"🤖 Responding: {response}")
             add_to_cache(response)
             print(f"  ⏳ Waiting 2s before sending...")
             time.sleep(2)
+            # Record the reply before sending: a crash in between loses one reply instead of doubling it
+            for m in covered:
+                store.mark_replied(m[0], m[1], 'listen')
             send_message(listen_from, response)
-            
-            last_rowid = rowid
             print("-" * 55)
         
+        if messages:
+            last_rowid = messages[-1][0]
+            store.set_watermark('listen', last_rowid)
+        
         # Check admin messages (if configured)
         if admin_number:
-            _, admin_body, admin_rowid, admin_is_from_me = get_last_message(admin_number, include_from_me=True)
+            admin_messages = get_messages_since(admin_number, last_admin_rowid)
+            admin_cutoff = time.time() - backlog_max_age * 60
             
-            # Only process messages that YOU sent (is_from_me=1) with @LLM prefix
-            if admin_body and admin_rowid != last_admin_rowid and admin_is_from_me == 1:
-                # Check for @LLM prefix
-                if admin_body.strip().upper().startswith('@LLM'):
-                    command = admin_body.strip()[4:].strip()  # Remove @LLM prefix
-                    print(f"\n🔧 [ADMIN] {admin_number}: {admin_body}")
-                    print(f"  📊 Admin Message ID: {admin_rowid}")
-                    print(f"  📝 Command: {command}")
-                    
-                    response = generate_admin_response(
-                        config['ollama_model'],
-                        config['ollama_url'],
-                        command
-                    )
-                    
-                    print(f"🤖 Admin response: {response}")
-                    print(f"  ⏳ Waiting 1s before sending...")
-                    time.sleep(1)
-                    send_message(admin_number, response)
-                    print("-" * 55)
-                else:
+            for admin_rowid, admin_guid, admin_body, admin_is_from_me, admin_sent_at, _ in admin_messages:
+                # Only process messages that YOU sent (is_from_me=1) with @LLM prefix
+                if not admin_body or admin_is_from_me != 1 or store.is_handled(admin_rowid, admin_guid):
+                    continue
+                if not admin_body.strip().upper().startswith('@LLM'):
                     print(f"  ℹ️  Ignoring admin message without @LLM prefix: {admin_body[:50]}...")
+                    continue
+                if admin_sent_at < admin_cutoff:
+                    print(f"  ⏭️  Skipping stale admin command {admin_rowid}: {admin_body[:50]}...")
+                    store.mark_processed(admin_rowid, admin_guid, 'admin')
+                    continue
                 
-                last_admin_rowid = admin_rowid
+                command = admin_body.strip()[4:].strip()  # Remove @LLM prefix
+                print(f"\n🔧 [ADMIN] {admin_number}: {admin_body}")
+                print(f"  📊 Admin Message ID: {admin_rowid}")
+                print(f"  📝 Command: {command}")
+                
+                response = generate_admin_response(
+                    config['ollama_model'],
+                    config['ollama_url'],
+                    command
+                )
+                
+                print(f"🤖 Admin response: {response}")
+                print(f"  ⏳ Waiting 1s before sending...")
+                time.sleep(1)
+                store.mark_replied(admin_rowid, admin_guid, 'admin')
+                send_message(admin_number, response)
+                print("-" * 55)
+            
+            if admin_messages:
+                last_admin_rowid = admin_messages[-1][0]
+                store.set_watermark('admin', last_admin_rowid)
         
+        store.commit_if_due()
         time.sleep(3)  # Check every 3 seconds
 
 if __name__ == "__main__":
@@ -0,0 +1,126 @@
+import json
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from difflib import SequenceMatcher
+
+import requests
+
+import latency
+
+DEFAULT_CANDIDATES = 1          # 1 = off, one plain generation
+DEFAULT_DEADLINE_SECONDS = 8    # Pick the best finished candidate at this point
+TEMPERATURES = [0.7, 0.9, 1.1, 0.8, 1.0, 1.2]
+
+# Persona rules for the partner replies
+BANNED_TERMS_RE = re.compile(r"\b(man|girl|girls|girlie|bro|dude|sis|buddy|pal)\b", re.IGNORECASE)
+QUESTION_PENALTY = 3.0
+BANNED_TERM_PENALTY = 3.0
+REPEAT_PENALTY = 4.0            # Scaled by how far similarity to a recent reply is above the floor
+REPEAT_SIMILARITY_FLOOR = 0.6   # Normal overlap with past replies (shared words, emojis) is free
+LENGTH_PENALTY = 2.0            # Scaled by relative distance beyond the tolerance
+LENGTH_TOLERANCE = 0.5          # Within +/-50% of the length target is fine
+GOOD_ENOUGH_SCORE = -0.5        # Stop waiting once a candidate scores at least this
+
+def clean(text):
+    text = text.strip()
+    if text.startswith('"') and text.endswith('"'):
+        text = text[1:-1]
+    return text
+
+def max_similarity(text, recent):
+    """Highest case-insensitive similarity (0-1) between text and any recent reply."""
+    lowered = text.lower()
+    return max((SequenceMatcher(None, lowered, r.lower()).ratio() for r in recent), default=0.0)
+
+def score_candidate(text, recent, length_words):
+    """Score a reply against the persona rules. 0 is perfect, lower is worse."""
+    if not text:
+        return float('-inf')
+    score = 0.0
+    if '?' in text:
+        score -= QUESTION_PENALTY
+    if BANNED_TERMS_RE.search(text):
+        score -= BANNED_TERM_PENALTY
+    similarity = max_similarity(text, recent)
+    if similarity > REPEAT_SIMILARITY_FLOOR:
+        score -= REPEAT_PENALTY * (similarity - REPEAT_SIMILARITY_FLOOR) / (1 - REPEAT_SIMILARITY_FLOOR)
+    words = len(text.split())
+    length_words = max(1, length_words)
+    distance = abs(words - length_words) / length_words
+    if distance > LENGTH_TOLERANCE:
+        score -= LENGTH_PENALTY * (distance - LENGTH_TOLERANCE)
+    return score
+
+def stream_candidate(url, data, timeout, cancel):
+    """Stream one generation, stopping early if cancelled.
+
+    Returns (text, seconds), or (None, None) if cancelled.
+    """
+    started = time.time()
+    parts = []
+    with requests.post(url, json=data, timeout=timeout, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if cancel.is_set():
+                return None, None
+            if not line:
+                continue
+            chunk = json.loads(line)
+            parts.append(chunk.get('response', ''))
+            if chunk.get('done'):
+                break
+    return clean(''.join(parts)), time.time() - started
+
+def generate_best(model, url, prompt, recent, n, deadline, options, timeout, length_words):
+    """Run n generations at once with different seeds/temperatures and return the best.
+
+    Candidates are scored as they finish. A good-enough candidate wins right
+    away; otherwise the best finished one wins at the deadline (or the first
+    to finish, if none has by then). The rest are cancelled. Raises the last
+    error if every candidate fails.
+    """
+    cancel = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=n)
+    futures = {}
+    for i in range(n):
+        candidate_options = dict(options, seed=random.randint(0, 2**31 - 1), temperature=TEMPERATURES[i % len(TEMPERATURES)])
+        data = {"model": model, "prompt": prompt, "stream": True, "options": candidate_options}
+        futures[executor.submit(stream_candidate, url, data, timeout, cancel)] = i
+
+    best, best_score, best_seconds, error = None, float('-inf'), None, None
+    started = time.time()
+    pending = set(futures)
+    try:
+        while pending:
+            remaining = deadline - (time.time() - started)
+            if remaining <= 0:
+                if best is not None:
+                    break
+                remaining = None  # Nothing usable yet - take the first one that finishes
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    text, seconds = future.result()
+                except Exception as e:
+                    error = e
+                    continue
+                score = score_candidate(text, recent, length_words)
+                print(f"  🎲 Candidate {futures[future] + 1}/{n} (score {score:.2f}): {text}")
+                if score > best_score:
+                    best, best_score, best_seconds = text, score, seconds
+            if best is not None and best_score >= GOOD_ENOUGH_SCORE:
+                break
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if best is None:
+        raise error or RuntimeError("No candidate produced a reply")
+    if pending:
+        print(f"  ✂️  Cancelled {len(pending)} unfinished candidate(s)")
+    # Only the winner counts, and in its own pool so it doesn't skew single-call deadlines
+    latency.record(model, url, best_seconds, latency.BEST_OF_POOL)
+    return best
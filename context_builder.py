@@ -0,0 +1,228 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import requests
+
+import attributed_body
+import latency
+
+SUMMARY_FILE = "conversation_summaries.json"
+CHAT_DB = "~/Library/Messages/chat.db"
+MAX_ROWID = 2**63 - 1  # No upper bound on the thread (live replies)
+DEFAULT_HISTORY_TURNS = 12        # Recent turns included verbatim
+DEFAULT_MAX_CONTEXT_TOKENS = 1024  # Hard cap on the whole reply prompt (see auto_responder)
+SUMMARY_REFRESH_TURNS = 10        # Refresh once this many turns have scrolled out unsummarized
+MAX_SUMMARY_BATCH = 40            # Most turns folded in per refresh (the newest ones win)
+MAX_SUMMARY_CHARS = 600
+
+# The 1:1 chat for a handle, found through chat_handle_join
+CHAT_FILTER = """
+cmj.chat_id IN (
+    SELECT chj.chat_id
+    FROM chat_handle_join chj
+    JOIN handle h ON h.rowid = chj.handle_id
+    JOIN chat c ON c.rowid = chj.chat_id
+    WHERE h.id LIKE ? AND c.style = 45  -- 45 = 1:1 chat, 43 = group
+)
+"""
+
+# One indexed query: walk chat_message_join (indexed on chat_id, message_date) for the newest rows
+THREAD_QUERY = f"""
+SELECT m.rowid, m.text, m.attributedBody, m.date_edited, m.is_from_me
+FROM chat_message_join cmj
+JOIN message m ON m.rowid = cmj.message_id
+WHERE {CHAT_FILTER} AND m.rowid < ?
+ORDER BY cmj.message_date DESC
+LIMIT ?
+"""
+
+# Turns between the last summarized row and the start of the recent window
+OLDER_QUERY = f"""
+SELECT m.rowid, m.text, m.attributedBody, m.date_edited, m.is_from_me
+FROM chat_message_join cmj
+JOIN message m ON m.rowid = cmj.message_id
+WHERE {CHAT_FILTER} AND m.rowid > ? AND m.rowid < ?
+ORDER BY m.rowid DESC
+LIMIT ?
+"""
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token)."""
+    return len(text) // 4 + 1
+
+_history_lock = threading.Lock()
+
+def _query_turns(query, params, db_path=None):
+    """Run a thread query and return (rowid, text, is_from_me) turns, oldest first."""
+    db_path = os.path.expanduser(db_path or CHAT_DB)
+    try:
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        conn.close()
+    except Exception as e:
+        print(f"Error reading conversation thread: {e}")
+        return []
+    rows = attributed_body.decode_rows(rows)
+    return [(rowid, text, is_from_me) for rowid, text, is_from_me in reversed(rows) if text]
+
+def _handle_pattern(phone):
+    phone_digits = ''.join(filter(str.isdigit, phone))
+    if not phone_digits:
+        return phone  # Email handle, match it exactly
+    return f"%{phone_digits[-10:]}%"
+
+def fetch_thread(phone, limit, db_path=None, before_rowid=None):
+    """Return up to `limit` most recent turns with this number, oldest first.
+
+    Each turn is (rowid, text, is_from_me). With before_rowid set, only turns
+    older than that row count (replaying history).
+    """
+    params = (_handle_pattern(phone), before_rowid or MAX_ROWID, limit)
+    return _query_turns(THREAD_QUERY, params, db_path)
+
+def fetch_older_turns(phone, after_rowid, before_rowid, limit=MAX_SUMMARY_BATCH, db_path=None):
+    """Return up to `limit` turns with after_rowid < rowid < before_rowid, oldest first."""
+    return _query_turns(OLDER_QUERY, (_handle_pattern(phone), after_rowid, before_rowid, limit), db_path)
+
+def format_turn(turn):
+    _, text, is_from_me = turn
+    speaker = "Me" if is_from_me else "Them"
+    return f"{speaker}: {text}"
+
+def load_summaries():
+    """Load rolling summaries ({phone: {...}}) from the summary file."""
+    try:
+        if os.path.exists(SUMMARY_FILE):
+            with open(SUMMARY_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"  ⚠️  Could not load summaries: {e}")
+    return {}
+
+def save_summaries(summaries):
+    try:
+        with open(SUMMARY_FILE, 'w') as f:
+            json.dump(summaries, f, indent=2)
+    except Exception as e:
+        print(f"  ⚠️  Could not save summaries: {e}")
+
+def summarize(model, url, previous_summary, turns):
+    """Fold older turns into the existing summary with one short LLM call."""
+    transcript = "\n".join(format_turn(t) for t in turns)
+    prompt = (
+        "Update this running summary of a text conversation. Keep names, plans, moods and "
+        f"inside jokes. Max 3 sentences.\n\nCurrent summary: {previous_summary or '(none)'}\n\n"
+        f"New messages:\n{transcript}\n\nUpdated summary:"
+    )
+    timeout, options = latency.request_budget(model, url, "summary", 30)
+    try:
+        started = time.time()
+        response = requests.post(url, json={"model": model, "prompt": prompt, "stream": False, "options": options}, timeout=timeout)
+        response.raise_for_status()
+        latency.record(model, url, time.time() - started)
+        return response.json()['response'].strip()[:MAX_SUMMARY_CHARS]
+    except Exception as e:
+        if isinstance(e, requests.exceptions.Timeout):
+            latency.record(model, url, timeout[1])
+        print(f"  ⚠️  Could not refresh summary: {e}")
+        return None
+
+def _latest_entry(history, phone, window_start_rowid):
+    """Newest in-memory summary that ends before the window (replay)."""
+    with _history_lock:
+        entries = [e for e in history.get(phone, []) if e['through_rowid'] < window_start_rowid]
+    return max(entries, key=lambda e: e['through_rowid'], default={"summary": "", "through_rowid": 0})
+
+def refresh_summary(model, url, phone, window_start_rowid, db_path=None, history=None):
+    """Fold turns that scrolled out of the recent window into the stored summary.
+
+    Only calls the LLM once at least SUMMARY_REFRESH_TURNS unsummarized turns
+    sit before window_start_rowid.
+
+    With history set ({phone: [entry, ...]}, used by replay) summaries are kept
+    there instead of SUMMARY_FILE, and only entries ending before the window are
+    used, so a replayed reply never sees a summary of later messages.
+    """
+    if history is None:
+        summaries = load_summaries()
+        entry = summaries.get(phone, {"summary": "", "through_rowid": 0})
+    else:
+        entry = _latest_entry(history, phone, window_start_rowid)
+    unsummarized = fetch_older_turns(phone, entry['through_rowid'], window_start_rowid, db_path=db_path)
+
+    if len(unsummarized) < SUMMARY_REFRESH_TURNS:
+        return entry['summary']
+
+    print(f"  📝 Refreshing conversation summary ({len(unsummarized)} new turns)...")
+    summary = summarize(model, url, entry['summary'], unsummarized)
+    if summary is None:
+        return entry['summary']
+
+    entry = {
+        "summary": summary,
+        "through_rowid": unsummarized[-1][0],
+        "updated": time.time(),
+    }
+    if history is None:
+        summaries[phone] = entry
+        save_summaries(summaries)
+    else:
+        with _history_lock:
+            history.setdefault(phone, []).append(entry)
+    return summary
+
+def build_context(model, url, phone, exclude_rowid=None, history_turns=DEFAULT_HISTORY_TURNS,
+                  max_tokens=DEFAULT_MAX_CONTEXT_TOKENS, db_path=None, before_rowid=None, summary_history=None):
+    """Build the conversation context block for a reply prompt.
+
+    Returns summary + recent turns, trimmed (oldest turns first) so the
+    result always stays within max_tokens. Callers pass whatever is left
+    of the prompt budget after the fixed parts.
+
+    db_path, before_rowid and summary_history let replay build the context
+    a message had when it arrived (see refresh_summary).
+    """
+    if max_tokens <= 0:
+        return ""
+
+    # One extra row in case the message being answered is among the newest
+    turns = fetch_thread(phone, history_turns + 1, db_path, before_rowid)
+    recent = [t for t in turns if t[0] != exclude_rowid][-history_turns:]
+
+    if recent:
+        summary = refresh_summary(model, url, phone, recent[0][0], db_path, summary_history)
+    elif summary_history is not None:
+        summary = _latest_entry(summary_history, phone, before_rowid or MAX_ROWID)['summary']
+    else:
+        summary = load_summaries().get(phone, {}).get('summary', '')
+
+    budget = max_tokens
+    summary_text = ""
+    if summary:
+        summary_text = f"Conversation so far: {summary}"
+        if estimate_tokens(summary_text) > budget // 2:
+            summary_text = summary_text[:(budget // 2) * 4]
+        budget -= estimate_tokens(summary_text)
+
+    # Keep the newest turns that fit, after the header and the blank line between parts
+    budget -= estimate_tokens("Recent messages:\n") + 1
+    lines = []
+    for turn in reversed(recent):
+        line = format_turn(turn)
+        cost = estimate_tokens(line)
+        if cost > budget:
+            break
+        lines.append(line)
+        budget -= cost
+    lines.reverse()
+
+    parts = []
+    if summary_text:
+        parts.append(summary_text)
+    if lines:
+        parts.append("Recent messages:\n" + "\n".join(lines))
+    return "\n\n".join(parts)
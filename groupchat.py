@@ -1,12 +1,25 @@
+import functools
 import json
 import requests
 import subprocess
 import time
 import sqlite3
 import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import attributed_body
+import latency
 
 RESPONSE_CACHE_FILE = "response_cache.json"
 MAX_CACHE_SIZE = 50  # Keep last 50 responses
+MAX_WORKERS = 8  # Chats that can be answered at the same time
+CHAT_IDLE_SECONDS = 3600  # Forget a chat's handler state after this long without messages
+
+MENTION_RE = re.compile(r'@jarvis\b', re.IGNORECASE)
+cache_lock = threading.Lock()
 
 def load_response_cache():
     """Load previous responses from cache file."""
@@ -42,7 +55,7 @@ def get_recent_phrases():
     cache = load_response_cache()
     return cache[-10:]  # Return last 10 responses for context
 
-def generate_group_response(model, url, incoming_message, sender_name=None):
+def generate_group_response(model, url, incoming_message, sender_name=None, queue_depth=0):
     """Generate a response to a group chat message with JARVIS personality."""
 
     print(f"  🔄 Loading personality...")
@@ -51,7 +64,9 @@ def generate_group_response(model, url, incoming_message, sender_name=None):
 
     # Get recent responses to avoid repetition
     print(f"  📚 Checking response cache...")
-    recent = get_recent_phrases()
+    # Other chats' workers rewrite the cache file; read it under the same lock
+    with cache_lock:
+        recent = get_recent_phrases()
     avoid_text = ""
     if recent:
         print(f"  ⚠️  Avoiding {len(recent)} recent phrases")
@@ -59,15 +74,19 @@ def generate_group_response(model, url, incoming_message, sender_name=None):
 
     prompt = f"You are JARVIS, a helpful AI assistant in a group chat. Be friendly, witty, and engaging. {personality}{avoid_text}\n\nGroup message: \"{incoming_message}\"\n\nYour response:"
 
+    timeout, options = latency.request_budget(model, url, "group", 30, queue_depth, personalities.get('length_targets'))
     data = {
         "model": model,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "options": options
     }
     print(f"  🧠 Sending to LLM (model: {model})...")
     try:
-        response = requests.post(url, json=data, timeout=30)
+        started = time.time()
+        response = requests.post(url, json=data, timeout=timeout)
         response.raise_for_status()
+        latency.record(model, url, time.time() - started)
         print(f"  ✓ LLM responded successfully")
         message = response.json()['response'].strip()
         # Remove surrounding quotes if present
@@ -76,7 +95,8 @@ def generate_group_response(model, url, incoming_message, sender_name=None):
         print(f"  📝 Generated response: {message}")
         return message
     except requests.exceptions.Timeout:
-        error_msg = "LLM request timed out (30s)"
+        latency.record(model, url, timeout[1])
+        error_msg = f"LLM request timed out ({timeout[1]:.0f}s)"
         print(f"  ❌ {error_msg}")
         return "Sorry, I'm a bit slow right now! 🤖"
     except requests.exceptions.ConnectionError:
@@ -91,83 +111,99 @@ def generate_group_response(model, url, incoming_message, sender_name=None):
         print(f"  ❌ Unexpected error: {type(e).__name__}: {e}")
         return "Oops, something went wrong! 🤷‍♂️"
 
-def send_message(phone, message):
-    """Send an iMessage to the specified phone number, fallback to SMS if fails."""
-    message = message.replace('"', '\\"')
-
-    # Try iMessage first
-    imessage_script = f'''
-tell application "Messages"
-    set targetService to 1st service whose service type = iMessage
-    set targetBuddy to buddy "{phone}" of targetService
-    send "{message}" to targetBuddy
-end tell
-'''
+def get_max_rowid():
+    """Get the newest message ROWID, used as the starting watermark."""
+    db_path = os.path.expanduser("~/Library/Messages/chat.db")
     try:
-        result = subprocess.run(['osascript', '-e', imessage_script], check=True, capture_output=True, text=True)
-        print(f"  ✓ Sent via iMessage to [{phone}]: {message}")
-        return True
+        conn = sqlite3.connect(db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(rowid) FROM message")
+        row = cursor.fetchone()
+        conn.close()
+        return row[0] or 0
     except Exception as e:
-        print(f"  ⚠ iMessage failed, trying SMS...")
+        print(f"Error reading Messages database: {e}")
+        return 0
 
-        # Fallback to SMS
-        sms_script = f'''
-tell application "Messages"
-    set targetService to 1st service whose service type = SMS
-    set targetBuddy to buddy "{phone}" of targetService
-    send "{message}" to targetBuddy
-end tell
-'''
-        try:
-            subprocess.run(['osascript', '-e', sms_script], check=True)
-            print(f"  ✓ Sent via SMS to [{phone}]: {message}")
-            return True
-        except Exception as e2:
-            print(f"  ✗ SMS also failed: {e2}")
-
-            # Last resort - try without specifying service type
-            generic_script = f'''
-tell application "Messages"
-    send "{message}" to buddy "{phone}"
-end tell
-'''
-            try:
-                subprocess.run(['osascript', '-e', generic_script], check=True)
-                print(f"  ✓ Sent (generic) to [{phone}]: {message}")
-                return True
-            except Exception as e3:
-                print(f"  ✗ All send methods failed: {e3}")
-                return False
-
-def get_last_message_from_any():
-    """Get the last message from any phone number that contains @JARVIS."""
+def get_new_chat_messages(since_rowid):
+    """Get every incoming message newer than since_rowid, across all chats, in one query.
+
+    Returns a list of (rowid, text, sender, chat_guid, chat_name), oldest first.
+    """
     db_path = os.path.expanduser("~/Library/Messages/chat.db")
 
     try:
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
 
-        # Get the most recent message from any sender
         query = """
-        SELECT m.rowid, m.text, m.is_from_me, m.date, h.id as phone
+        SELECT m.rowid, m.text, m.attributedBody, m.date_edited, h.id, c.guid, c.display_name
         FROM message m
-        JOIN handle h ON m.handle_id = h.rowid
-        WHERE m.is_from_me = 0  -- Only incoming messages
-        ORDER BY m.date DESC
-        LIMIT 1
+        JOIN chat_message_join cmj ON cmj.message_id = m.rowid
+        JOIN chat c ON c.rowid = cmj.chat_id
+        LEFT JOIN handle h ON h.rowid = m.handle_id
+        WHERE m.rowid > ? AND m.is_from_me = 0  -- Only incoming messages
+        ORDER BY m.rowid
         """
 
-        cursor.execute(query)
-        row = cursor.fetchone()
+        cursor.execute(query, (since_rowid,))
+        rows = cursor.fetchall()
         conn.close()
-
-        if row:
-            rowid, text, is_from_me, date, phone = row
-            return (text, rowid, phone)
-        return (None, None, None)
+        # Decode the whole batch at once; text is NULL on newer macOS
+        return attributed_body.decode_rows(rows)
     except Exception as e:
         print(f"Error reading Messages database: {e}")
-        return (None, None, None)
+        return []
+
+def send_chat_message(chat_guid, message):
+    """Send a message to a chat by GUID, so group replies go back to the group."""
+    message = message.replace('"', '\\"')
+    script = f'''
+tell application "Messages"
+    send "{message}" to chat id "{chat_guid}"
+end tell
+'''
+    try:
+        subprocess.run(['osascript', '-e', script], check=True, capture_output=True, text=True)
+        print(f"  ✓ Sent to chat [{chat_guid}]: {message}")
+        return True
+    except Exception as e:
+        print(f"  ✗ Send to chat [{chat_guid}] failed: {e}")
+        return False
+
+def handle_mention(config, chat_guid, chat_name, sender_phone, body, queue_depth=0):
+    """Generate and send a reply for one @JARVIS mention. Runs on a worker thread."""
+    print(f"\n🤖 JARVIS mentioned by [{sender_phone}] in [{chat_name or chat_guid}]")
+    print(f"💬 Message: {body}")
+
+    # Remove @JARVIS from the message for processing
+    clean_message = MENTION_RE.sub('', body).strip()
+
+    if not clean_message:  # Only respond if there's content after @JARVIS
+        print("  ℹ️  @JARVIS mentioned but no message content")
+        return
+
+    response = generate_group_response(
+        config['ollama_model'],
+        config['ollama_url'],
+        clean_message,
+        queue_depth=queue_depth
+    )
+
+    print(f"🤖 JARVIS responding in [{chat_name or chat_guid}]: {response}")
+    with cache_lock:
+        add_to_cache(response)
+    time.sleep(2)
+    send_chat_message(chat_guid, response)
+    print("-" * 55)
+
+def log_failure(chat_guid, future):
+    """Done callback for handle_mention: report errors, nothing else reads the result."""
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error:
+        print(f"  ❌ Reply in [{chat_guid}] failed: {type(error).__name__}: {error}")
 
 def load_config():
     with open('config.json', 'r') as f:
@@ -181,7 +217,9 @@ def load_personality():
 def check_ollama(model, url):
     """Verify Ollama is running and model exists."""
     try:
-        response = requests.post(url, json={"model": model, "prompt": "hi", "stream": False}, timeout=15)
+        # Same num_ctx as real requests so the model isn't reloaded on the first reply
+        data = {"model": model, "prompt": "hi", "stream": False, "options": {"num_ctx": latency.num_ctx_for(model)}}
+        response = requests.post(url, json=data, timeout=15)
         response.raise_for_status()
         return True, None
     except requests.exceptions.HTTPError:
@@ -193,15 +231,11 @@ def check_ollama(model, url):
 
 def main():
     config = load_config()
-
-    # Get JARVIS dedicated number (optional)
-    jarvis_number = config.get('jarvis_number')
+    latency.configure(config)
 
     print("=" * 55)
     print("🤖 JARVIS GROUP CHAT BOT")
     print("=" * 55)
-    if jarvis_number:
-        print(f"JARVIS Number: {jarvis_number}")
     print("\n🔍 Checking Ollama...")
     ok, err = check_ollama(config['ollama_model'], config['ollama_url'])
     if ok:
@@ -223,57 +257,49 @@ def main():
         print("  ⚠️  Bot may not work properly. Check your setup.")
         return
 
-    print("\n📱 Listening for @JARVIS mentions from any number")
+    print("\n📱 Listening for @JARVIS mentions in all chats")
     print("\n" + "-" * 55)
     print("Waiting for messages... (Ctrl+C to stop)\n")
 
     # Get initial state
-    _, last_rowid, _ = get_last_message_from_any()
+    last_rowid = get_max_rowid()
+
+    # Per-chat handler state: queued mentions, the running reply and when the chat was last active.
+    # last_rowid alone keeps rows from being seen twice.
+    chats = {}
+    executor = ThreadPoolExecutor(max_workers=config.get('group_workers', MAX_WORKERS))
 
     poll_count = 0
     while True:
         poll_count += 1
         if poll_count % 20 == 0:  # Every 60 seconds (20 * 3s)
-            print(f"  🔍 Still listening... (checked {poll_count} times)")
-
-        # Check for new messages from any sender
-        body, rowid, sender_phone = get_last_message_from_any()
-
-        # New incoming message
-        if body and rowid != last_rowid:
-            # Check if message contains @JARVIS
-            if '@JARVIS' in body.upper():
-                print(f"\n🤖 JARVIS mentioned by [{sender_phone}]")
-                print(f"💬 Message: {body}")
-                print(f"  📊 Message ID: {rowid}")
-
-                # Remove @JARVIS from the message for processing
-                clean_message = body.replace('@JARVIS', '').replace('@jarvis', '').strip()
-
-                if clean_message:  # Only respond if there's content after @JARVIS
-                    response = generate_group_response(
-                        config['ollama_model'],
-                        config['ollama_url'],
-                        clean_message
-                    )
-
-                    print(f"🤖 JARVIS responding: {response}")
-                    add_to_cache(response)
-                    print(f"  ⏳ Waiting 2s before sending...")
-                    time.sleep(2)
-                    
-                    # Use JARVIS number if configured, otherwise respond to sender
-                    response_number = jarvis_number if jarvis_number else sender_phone
-                    send_message(response_number, response)
-                    
-                    if jarvis_number and jarvis_number != sender_phone:
-                        print(f"  📤 Sent from JARVIS number: {jarvis_number}")
-                else:
-                    print("  ℹ️  @JARVIS mentioned but no message content")
-
-                print("-" * 55)
-
-            last_rowid = rowid
+            print(f"  🔍 Still listening... (checked {poll_count} times, {len(chats)} chats)")
+
+        # One pass over new rows for every chat
+        for rowid, body, sender_phone, chat_guid, chat_name in get_new_chat_messages(last_rowid):
+            last_rowid = max(last_rowid, rowid)
+            state = chats.setdefault(chat_guid, {"pending": deque(), "future": None, "last_seen": 0})
+            state['last_seen'] = time.time()
+
+            if body and MENTION_RE.search(body):
+                state['pending'].append((chat_name, sender_phone, body))
+
+        # Start the next reply for every chat that isn't already busy
+        queue_depth = sum(len(state['pending']) for state in chats.values())
+        for chat_guid, state in chats.items():
+            if state['future'] and not state['future'].done():
+                continue
+            if state['pending']:
+                chat_name, sender_phone, body = state['pending'].popleft()
+                state['future'] = executor.submit(handle_mention, config, chat_guid, chat_name, sender_phone, body, queue_depth)
+                state['future'].add_done_callback(functools.partial(log_failure, chat_guid))
+
+        # Drop chats that have gone quiet so the dict doesn't grow with every chat ever seen
+        idle_before = time.time() - CHAT_IDLE_SECONDS
+        for chat_guid in [guid for guid, state in chats.items()
+                          if state['last_seen'] < idle_before and not state['pending']
+                          and (state['future'] is None or state['future'].done())]:
+            del chats[chat_guid]
 
         time.sleep(3)  # Check every 3 seconds
 
@@ -0,0 +1,93 @@
+import threading
+from collections import deque
+
+CONNECT_TIMEOUT = 3
+MIN_READ_TIMEOUT = 5
+MAX_READ_TIMEOUT = 120
+MIN_SAMPLES = 5          # Use the caller's fixed timeout until we've seen this many requests
+WINDOW = 100             # Latencies kept per model/backend for p95
+EWMA_ALPHA = 0.2
+DEADLINE_MARGIN = 1.5    # Read deadline = p95 * margin
+MIN_DEADLINE_MARGIN = 1.1
+TOKENS_PER_WORD = 1.4
+PREDICT_HEADROOM = 1.5   # Let replies run a bit past the length target before cutting off
+# One context size per model: Ollama reloads the runner whenever num_ctx changes.
+# Must cover max_context_tokens plus the largest num_predict.
+DEFAULT_NUM_CTX = 4096
+
+# Reply length targets in words, overridable with "length_targets" in personality.json
+DEFAULT_LENGTH_TARGETS = {
+    "girlfriend": 25,
+    "admin": 150,
+    "group": 60,
+    "proactive": 20,
+    "summary": 80,
+}
+
+SINGLE_POOL = "single"
+BEST_OF_POOL = "best_of"  # Parallel best-of-N decoding is slower per request, so it gets its own stats
+
+_num_ctx = {}  # model -> pinned num_ctx
+_stats = {}  # (model, url, pool) -> {"ewma": float, "samples": deque}
+_lock = threading.Lock()
+
+def record(model, url, seconds, pool=SINGLE_POOL):
+    """Record how long a request took (or the deadline it hit, for timeouts)."""
+    with _lock:
+        entry = _stats.setdefault((model, url, pool), {"ewma": seconds, "samples": deque(maxlen=WINDOW)})
+        entry['ewma'] = EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * entry['ewma']
+        entry['samples'].append(seconds)
+
+def get_stats(model, url, pool=SINGLE_POOL):
+    """Return (ewma, p95, sample_count) for a model/backend."""
+    with _lock:
+        entry = _stats.get((model, url, pool))
+        if not entry:
+            return None, None, 0
+        samples = sorted(entry['samples'])
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        return entry['ewma'], p95, len(samples)
+
+def _pressure(queue_depth):
+    """Shrink factor for budgets when other requests are waiting."""
+    return 1 + 0.25 * max(0, queue_depth)
+
+def read_deadline(model, url, fallback, queue_depth=0, pool=SINGLE_POOL):
+    """Read timeout for the next request, from observed p95 latency."""
+    ewma, p95, count = get_stats(model, url, pool)
+    if count < MIN_SAMPLES:
+        return fallback
+    # Under queue pressure cut stalled requests off sooner
+    margin = max(MIN_DEADLINE_MARGIN, DEADLINE_MARGIN - 0.1 * max(0, queue_depth))
+    deadline = max(p95, ewma) * margin
+    return min(MAX_READ_TIMEOUT, max(MIN_READ_TIMEOUT, deadline))
+
+def configure(config):
+    """Pin num_ctx for the configured model ("num_ctx" in config.json)."""
+    _num_ctx[config['ollama_model']] = int(config.get('num_ctx', DEFAULT_NUM_CTX))
+
+def num_ctx_for(model):
+    return _num_ctx.get(model, DEFAULT_NUM_CTX)
+
+def generation_options(model, length_words, queue_depth=0):
+    """Ollama options capping reply length, with the model's pinned context size."""
+    num_predict = int(length_words * TOKENS_PER_WORD * PREDICT_HEADROOM / _pressure(queue_depth))
+    num_predict = max(num_predict, int(length_words * TOKENS_PER_WORD))
+    return {"num_predict": num_predict, "num_ctx": num_ctx_for(model)}
+
+def length_target(persona, length_targets=None):
+    """Reply length in words for a persona, with personality.json overrides."""
+    targets = dict(DEFAULT_LENGTH_TARGETS)
+    targets.update(length_targets or {})
+    return targets.get(persona, DEFAULT_LENGTH_TARGETS['girlfriend'])
+
+def request_budget(model, url, persona, fallback_timeout, queue_depth=0, length_targets=None,
+                   pool=SINGLE_POOL):
+    """Return (timeout, options) for one generate request.
+
+    timeout is a (connect, read) tuple for requests; options goes in the
+    request body's "options" field.
+    """
+    deadline = read_deadline(model, url, fallback_timeout, queue_depth, pool)
+    options = generation_options(model, length_target(persona, length_targets), queue_depth)
+    return (CONNECT_TIMEOUT, deadline), options
@@ -3,27 +3,39 @@ import requests
 import subprocess
 import random
 import time
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import latency
+import scheduler
 
 def load_config():
     with open('config.json', 'r') as f:
         return json.load(f)
 
-def generate_message(model, url, prompt):
+def generate_message(model, url, prompt, queue_depth=0):
 
+    timeout, options = latency.request_budget(model, url, "proactive", 10, queue_depth)
     data = {
         "model": model,
         "prompt": prompt,
-        "stream": False
+        "stream": False,
+        "options": options
     }
     try:
-        response = requests.post(url, json=data, timeout=10)
+        started = time.time()
+        response = requests.post(url, json=data, timeout=timeout)
         response.raise_for_status()
+        latency.record(model, url, time.time() - started)
         message = response.json()['response'].strip()
         # Remove surrounding quotes if present
         if message.startswith('"') and message.endswith('"'):
             message = message[1:-1]
         return message
     except Exception as e:
+        if isinstance(e, requests.exceptions.Timeout):
+            latency.record(model, url, timeout[1])
         print(f"Error generating message: {e}")
         return "I love you! 💕"
 
@@ -45,13 +57,56 @@ end tell
 
 def main():
     config = load_config()
+    latency.configure(config)
+    recipients = {r['phone']: r for r in scheduler.get_recipients(config)}
+    if not recipients:
+        print("No recipients configured. Add 'recipients' to config.json.")
+        return
+    pregenerate_seconds = config.get('pregenerate_minutes', scheduler.DEFAULT_PREGENERATE_MINUTES) * 60
+
     print("Starting smart automatic messages. Press Ctrl+C to stop.")
+    heap = scheduler.build_schedule(recipients.values(), scheduler.load_schedule(), time.time())
+    scheduler.save_schedule(heap)
+    for send_at, phone in sorted(heap):
+        print(f"  📅 [{phone}] next message at {datetime.fromtimestamp(send_at):%Y-%m-%d %H:%M:%S}")
+
+    # Messages are generated ahead of time so the send doesn't wait on the LLM
+    executor = ThreadPoolExecutor(max_workers=1)
+    prepared = {}  # phone -> Future with the generated message
+
     while True:
-        message = generate_message(config['ollama_model'], config['ollama_url'], config['prompt'])
-        send_message(config['phone_number'], message)
-        # Random sleep between 10 seconds and 24 hours
-        sleep_time = 10
-        print(f"Sleeping for {sleep_time} seconds.")
+        now = time.time()
+
+        # Start generating anything that is inside the pre-generation window
+        for send_at, phone in sorted(heap):
+            if send_at - pregenerate_seconds > now:
+                break
+            if phone not in prepared:
+                r = recipients[phone]
+                print(f"  🧠 [{phone}] Pre-generating message for {datetime.fromtimestamp(send_at):%H:%M:%S}")
+                prepared[phone] = executor.submit(generate_message, config['ollama_model'], config['ollama_url'], r['prompt'], len(prepared))
+
+        send_at, phone = heap[0]
+        if send_at <= now:
+            heapq.heappop(heap)
+            future = prepared.pop(phone, None)
+            if future is None:
+                future = executor.submit(generate_message, config['ollama_model'], config['ollama_url'], recipients[phone]['prompt'])
+            send_message(phone, future.result())
+
+            next_at = scheduler.next_send_time(recipients[phone], time.time())
+            heapq.heappush(heap, (next_at, phone))
+            scheduler.save_schedule(heap)
+            print(f"  📅 [{phone}] next message at {datetime.fromtimestamp(next_at):%Y-%m-%d %H:%M:%S}")
+            continue
+
+        # Wake for the next send or the next pre-generation, whichever comes first
+        wake_at = send_at
+        for pending_at, pending_phone in sorted(heap):
+            if pending_phone not in prepared:
+                wake_at = min(wake_at, pending_at - pregenerate_seconds)
+                break
+        sleep_time = max(0, min(wake_at - now, 60))
         time.sleep(sleep_time)
 
 if __name__ == "__main__":
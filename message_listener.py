@@ -7,6 +7,9 @@ import sqlite3
 import os
 from datetime import datetime
 
+import attributed_body
+import latency
+
 def load_config():
     with open('config.json', 'r') as f:
         return json.load(f)
@@ -17,29 +20,37 @@ def generate_message(model, url, prompt, incoming_message=None):
     else:
         full_prompt = prompt
 
+    timeout, options = latency.request_budget(model, url, "girlfriend", 10)
     data = {
         "model": model,
         "prompt": full_prompt,
-        "stream": False
+        "stream": False,
+        "options": options
     }
     try:
-        response = requests.post(url, json=data, timeout=10)
+        started = time.time()
+        response = requests.post(url, json=data, timeout=timeout)
         response.raise_for_status()
+        latency.record(model, url, time.time() - started)
         message = response.json()['response'].strip()
         # Remove surrounding quotes if present
         if message.startswith('"') and message.endswith('"'):
             message = message[1:-1]
         return message
     except Exception as e:
+        if isinstance(e, requests.exceptions.Timeout):
+            latency.record(model, url, timeout[1])
         print(f"Error generating message: {e}")
         return "I love you! 💕"
 
 def check_ollama_model(model, url):
     """Test if the Ollama model is available and working."""
+    # Same num_ctx as real requests so the model isn't reloaded on the first reply
     test_data = {
         "model": model,
         "prompt": "Say hi",
-        "stream": False
+        "stream": False,
+        "options": {"num_ctx": latency.num_ctx_for(model)}
     }
     try:
         response = requests.post(url, json=test_data, timeout=15)
@@ -85,7 +96,7 @@ def get_last_message(phone):
         # Query for the last message from this phone number
         # is_from_me = 0 means it's an incoming message
         query = """
-        SELECT m.rowid, m.text, m.is_from_me, m.date
+        SELECT m.rowid, m.text, m.attributedBody, m.date_edited, m.is_from_me, m.date
         FROM message m
         JOIN handle h ON m.handle_id = h.rowid
         WHERE h.id LIKE ?
@@ -99,7 +110,9 @@ def get_last_message(phone):
         conn.close()
         
         if row:
-            rowid, text, is_from_me, date = row
+            rowid, text, body_blob, date_edited, is_from_me, date = row
+            # text is NULL on newer macOS, the content is only in attributedBody
+            text = attributed_body.get_text(rowid, text, body_blob, date_edited)
             # is_from_me = 0 means incoming (from her), 1 means outgoing (from you)
             return (is_from_me == 0, text, rowid)
         
@@ -110,6 +123,7 @@ def get_last_message(phone):
 
 def main():
     config = load_config()
+    latency.configure(config)
     listen_number = config['listen_from']
     send_number = config['sending_from']
     
@@ -0,0 +1,183 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, ALL_COMPLETED, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import attributed_body
+import best_of_n
+import context_builder
+import latency
+from auto_responder import load_config, load_personality, assemble_response_prompt, classify_message
+
+DEFAULT_REPORT = "replay.jsonl"
+DEFAULT_WORKERS = 4
+FETCH_BATCH = 500
+RECENT_PER_CHAT = 10  # Same dedupe window as the live response cache
+
+QUERY = """
+SELECT m.rowid, m.text, m.attributedBody, m.date_edited, h.id, m.associated_message_type
+FROM message m
+JOIN handle h ON m.handle_id = h.rowid
+WHERE m.is_from_me = 0 AND h.id LIKE ?
+ORDER BY m.rowid
+"""
+
+def load_done(report_path):
+    """ROWIDs already in the report, so a re-run skips them. Failed rows are retried."""
+    done = set()
+    if not os.path.exists(report_path):
+        return done
+    with open(report_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Partial last line from an interrupted run
+            if 'error' not in record:
+                done.add(record['rowid'])
+    return done
+
+def stream_messages(db_path, handle_filter, done):
+    """Yield (rowid, text, handle, associated_type) for incoming messages, in batches."""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    cursor = conn.cursor()
+    cursor.execute(QUERY, (handle_filter,))
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH)
+        if not rows:
+            break
+        rows = [r for r in rows if r[0] not in done]
+        for row in attributed_body.decode_rows(rows):
+            yield row
+    conn.close()
+
+def generate(session, config, prompt, options):
+    """One non-streaming generation. Returns (response, stats)."""
+    data = {
+        "model": config['ollama_model'],
+        "prompt": prompt,
+        "stream": False,
+        "options": options
+    }
+    started = time.time()
+    response = session.post(config['ollama_url'], json=data, timeout=config.get('replay_timeout', 120))
+    response.raise_for_status()
+    body = response.json()
+    message = body['response'].strip()
+    if message.startswith('"') and message.endswith('"'):
+        message = message[1:-1]
+    return message, {
+        "latency_s": round(time.time() - started, 3),
+        "prompt_tokens": body.get('prompt_eval_count'),
+        "completion_tokens": body.get('eval_count'),
+    }
+
+def process(session, config, personalities, recent, recent_lock, summaries, db_path, row):
+    rowid, text, handle, associated_type = row
+    record = {"rowid": rowid, "handle": handle, "incoming": text, "kind": classify_message(text, associated_type)}
+    if record['kind'] != "reply":
+        return record
+
+    with recent_lock:
+        avoid = list(recent[handle])
+    model = config['ollama_model']
+    personality = personalities.get('girlfriend_personality', 'Be a helpful and friendly boyfriend.')
+    length_words = latency.length_target('girlfriend', personalities.get('length_targets'))
+    best_of = config.get('best_of_n', best_of_n.DEFAULT_CANDIDATES)
+    # Same prompt as the live loop, with the thread as it was when this message arrived.
+    # Summaries live in `summaries`, never the live conversation_summaries.json.
+    try:
+        prompt, avoid = assemble_response_prompt(
+            model, config['ollama_url'], personality, text, avoid,
+            config.get('max_context_tokens', context_builder.DEFAULT_MAX_CONTEXT_TOKENS),
+            context_phone=handle,
+            history_turns=config.get('history_turns', context_builder.DEFAULT_HISTORY_TURNS),
+            db_path=db_path,
+            before_rowid=rowid,
+            summary_history=summaries
+        )
+        # Same length budget as the live loop; the deadline stays fixed so slow replies are still measured
+        options = latency.generation_options(model, length_words)
+        if best_of > 1:
+            started = time.time()
+            message = best_of_n.generate_best(model, config['ollama_url'], prompt, avoid, best_of,
+                                              config.get('best_of_deadline_seconds', best_of_n.DEFAULT_DEADLINE_SECONDS),
+                                              options, config.get('replay_timeout', 120), length_words)
+            stats = {"latency_s": round(time.time() - started, 3), "candidates": best_of}
+        else:
+            message, stats = generate(session, config, prompt, options)
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+        return record
+
+    record['response'] = message
+    record.update(stats)
+    with recent_lock:
+        # Same near-repeat rule best-of-N scores against
+        similarity = best_of_n.max_similarity(message, recent[handle])
+        record['similarity'] = round(similarity, 3)
+        record['duplicate'] = similarity > best_of_n.REPEAT_SIMILARITY_FLOOR
+        recent[handle].append(message)
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay chat.db history through the reply pipeline without sending.")
+    parser.add_argument('db', help="Path to a copy of chat.db")
+    parser.add_argument('--report', default=DEFAULT_REPORT, help="JSONL report (appended to, used to resume)")
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help="Parallel LLM requests")
+    parser.add_argument('--from', dest='handle', help="Only replay messages from this number")
+    parser.add_argument('--limit', type=int, help="Stop after this many messages")
+    args = parser.parse_args()
+
+    config = load_config()
+    latency.configure(config)
+    personalities = load_personality()
+    handle_filter = f"%{''.join(filter(str.isdigit, args.handle))[-10:]}%" if args.handle else "%"
+
+    done = load_done(args.report)
+    print(f"🔁 Replaying {args.db} with {args.workers} workers ({len(done)} already done)")
+
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_maxsize=args.workers))
+    session.mount('https://', HTTPAdapter(pool_maxsize=args.workers))
+    recent = defaultdict(lambda: deque(maxlen=RECENT_PER_CHAT))
+    recent_lock = threading.Lock()
+    summaries = {}  # handle -> [summary entries], in memory only
+
+    started = time.time()
+    count = 0
+    in_flight = set()
+    with open(args.report, 'a') as report, ThreadPoolExecutor(max_workers=args.workers) as executor:
+        def drain(return_when):
+            nonlocal in_flight, count
+            finished, in_flight = wait(in_flight, return_when=return_when)
+            for future in finished:
+                report.write(json.dumps(future.result(), ensure_ascii=False) + "\n")
+                count += 1
+                if count % 100 == 0:
+                    report.flush()
+                    rate = count / (time.time() - started)
+                    print(f"  📊 {count} messages ({rate:.1f}/s)")
+
+        for i, row in enumerate(stream_messages(args.db, handle_filter, done)):
+            if args.limit is not None and i >= args.limit:
+                break
+            in_flight.add(executor.submit(process, session, config, personalities, recent, recent_lock,
+                                         summaries, args.db, row))
+            # Keep a bounded queue so memory stays flat on big databases
+            if len(in_flight) >= args.workers * 2:
+                drain(FIRST_COMPLETED)
+        if in_flight:
+            drain(ALL_COMPLETED)
+
+    print(f"✓ Done: {count} messages in {time.time() - started:.0f}s, report in {args.report}")
+
+if __name__ == "__main__":
+    main()
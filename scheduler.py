@@ -0,0 +1,124 @@
+import json
+import os
+import random
+import heapq
+from datetime import datetime, timedelta
+
+SCHEDULE_FILE = "schedule_state.json"
+
+DEFAULT_MIN_HOURS = 1
+DEFAULT_MAX_HOURS = 24
+DEFAULT_CATCH_UP = "send"          # "send" = send one missed message on startup, "skip" = reschedule
+DEFAULT_CATCH_UP_GRACE_MINUTES = 60  # Missed by more than this -> always skip
+DEFAULT_PREGENERATE_MINUTES = 5
+
+def get_recipients(config):
+    """Build the recipient list from config.
+
+    Uses the `recipients` list if present, otherwise falls back to the
+    single `phone_number` / `listen_from` entry so old configs keep working.
+    """
+    recipients = config.get('recipients')
+    if not recipients:
+        phone = config.get('phone_number') or config.get('listen_from')
+        recipients = [{"phone": phone}] if phone else []
+
+    result = []
+    for r in recipients:
+        result.append({
+            "phone": r['phone'],
+            "prompt": r.get('prompt', config.get('prompt', '')),
+            "min_hours": float(r.get('min_hours', config.get('min_hours', DEFAULT_MIN_HOURS))),
+            "max_hours": float(r.get('max_hours', config.get('max_hours', DEFAULT_MAX_HOURS))),
+            "quiet_hours": r.get('quiet_hours', config.get('quiet_hours')),
+            "catch_up": r.get('catch_up', config.get('catch_up', DEFAULT_CATCH_UP)),
+            "catch_up_grace_minutes": float(r.get('catch_up_grace_minutes', config.get('catch_up_grace_minutes', DEFAULT_CATCH_UP_GRACE_MINUTES))),
+        })
+    return result
+
+def _to_minutes(value):
+    """Convert "HH:MM" or an hour number to minutes after midnight."""
+    if isinstance(value, str):
+        hours, _, minutes = value.partition(':')
+        return int(hours) * 60 + int(minutes or 0)
+    return int(float(value) * 60)
+
+def quiet_window_end(dt, quiet_hours):
+    """Return the end of the quiet window containing dt, or None if dt is not in one.
+
+    quiet_hours is [start, end], e.g. ["22:00", "08:00"]. Windows may wrap midnight.
+    """
+    if not quiet_hours:
+        return None
+    start = _to_minutes(quiet_hours[0])
+    end = _to_minutes(quiet_hours[1])
+    if start == end:
+        return None
+
+    minute_of_day = dt.hour * 60 + dt.minute
+    midnight = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if start < end:
+        # Same-day window, e.g. 13:00-15:00
+        if start <= minute_of_day < end:
+            return midnight + timedelta(minutes=end)
+        return None
+
+    # Window wraps midnight, e.g. 22:00-08:00
+    if minute_of_day >= start:
+        return midnight + timedelta(days=1, minutes=end)
+    if minute_of_day < end:
+        return midnight + timedelta(minutes=end)
+    return None
+
+def push_out_of_quiet_hours(ts, recipient):
+    """Move a timestamp to the end of quiet hours (plus a little jitter) if it falls inside them."""
+    dt = datetime.fromtimestamp(ts)
+    end = quiet_window_end(dt, recipient['quiet_hours'])
+    if end is None:
+        return ts
+    return end.timestamp() + random.uniform(0, 30 * 60)
+
+def next_send_time(recipient, after):
+    """Pick a random send time in the recipient's window, outside quiet hours."""
+    delay = random.uniform(recipient['min_hours'], recipient['max_hours']) * 3600
+    return push_out_of_quiet_hours(after + delay, recipient)
+
+def load_schedule():
+    """Load saved send times ({phone: timestamp}) from the schedule file."""
+    try:
+        if os.path.exists(SCHEDULE_FILE):
+            with open(SCHEDULE_FILE, 'r') as f:
+                return json.load(f)
+    except Exception as e:
+        print(f"  ⚠️  Could not load schedule: {e}")
+    return {}
+
+def save_schedule(heap):
+    """Persist the heap so restarts keep the same send times."""
+    try:
+        with open(SCHEDULE_FILE, 'w') as f:
+            json.dump({phone: send_at for send_at, phone in heap}, f, indent=2)
+    except Exception as e:
+        print(f"  ⚠️  Could not save schedule: {e}")
+
+def build_schedule(recipients, saved, now):
+    """Build the timer heap of (send_at, phone), applying catch-up rules to missed sends."""
+    heap = []
+    for r in recipients:
+        phone = r['phone']
+        send_at = saved.get(phone)
+
+        if send_at is None:
+            send_at = next_send_time(r, now)
+        elif send_at < now:
+            missed_minutes = (now - send_at) / 60
+            if r['catch_up'] == 'send' and missed_minutes <= r['catch_up_grace_minutes']:
+                print(f"  ⏰ [{phone}] Missed a send {missed_minutes:.0f} min ago, catching up")
+                send_at = push_out_of_quiet_hours(now, r)
+            else:
+                print(f"  ⏭️  [{phone}] Skipping send missed {missed_minutes:.0f} min ago")
+                send_at = next_send_time(r, now)
+
+        heapq.heappush(heap, (send_at, phone))
+    return heap
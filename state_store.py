@@ -0,0 +1,91 @@
+import sqlite3
+import time
+
+STATE_DB_FILE = "state.db"
+COMMIT_EVERY = 20          # Batch up to this many writes per commit
+COMMIT_INTERVAL = 5        # ...or commit after this many seconds
+LEDGER_RETENTION_DAYS = 30
+
+class StateStore:
+    """Local SQLite store for per-source watermarks and a processed/replied ledger.
+
+    Writes are batched, except mark_replied which commits immediately so a
+    crash right after sending can never cause a second reply.
+    """
+
+    def __init__(self, path=STATE_DB_FILE):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+        CREATE TABLE IF NOT EXISTS watermark (
+            source TEXT PRIMARY KEY,
+            last_rowid INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS ledger (
+            msg_rowid INTEGER PRIMARY KEY,
+            guid TEXT,
+            source TEXT NOT NULL,
+            status TEXT NOT NULL,  -- 'processed' or 'replied'
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ledger_guid ON ledger(guid);
+        """)
+        self.conn.execute("DELETE FROM ledger WHERE updated < ?", (time.time() - LEDGER_RETENTION_DAYS * 86400,))
+        self.conn.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def get_watermark(self, source):
+        row = self.conn.execute("SELECT last_rowid FROM watermark WHERE source = ?", (source,)).fetchone()
+        return row[0] if row else None
+
+    def set_watermark(self, source, rowid):
+        self.conn.execute(
+            "INSERT INTO watermark (source, last_rowid) VALUES (?, ?) "
+            "ON CONFLICT(source) DO UPDATE SET last_rowid = MAX(last_rowid, excluded.last_rowid)",
+            (source, rowid)
+        )
+        self._maybe_commit()
+
+    def is_handled(self, msg_rowid, guid=None):
+        """True if this message was already processed or replied to."""
+        if guid:
+            row = self.conn.execute("SELECT 1 FROM ledger WHERE msg_rowid = ? OR guid = ?", (msg_rowid, guid)).fetchone()
+        else:
+            row = self.conn.execute("SELECT 1 FROM ledger WHERE msg_rowid = ?", (msg_rowid,)).fetchone()
+        return row is not None
+
+    def mark_processed(self, msg_rowid, guid, source):
+        """Record a message that was seen but intentionally not replied to."""
+        self.conn.execute(
+            "INSERT OR IGNORE INTO ledger (msg_rowid, guid, source, status, updated) VALUES (?, ?, ?, 'processed', ?)",
+            (msg_rowid, guid, source, time.time())
+        )
+        self._maybe_commit()
+
+    def mark_replied(self, msg_rowid, guid, source):
+        """Record a reply. Committed right away."""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO ledger (msg_rowid, guid, source, status, updated) VALUES (?, ?, ?, 'replied', ?)",
+            (msg_rowid, guid, source, time.time())
+        )
+        self.flush()
+
+    def flush(self):
+        self.conn.commit()
+        self.pending = 0
+        self.last_commit = time.time()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def commit_if_due(self):
+        """Commit pending writes if the batch is full or old enough. Call once per poll."""
+        if self.pending and (self.pending >= COMMIT_EVERY or time.time() - self.last_commit >= COMMIT_INTERVAL):
+            self.flush()
+
+    def _maybe_commit(self):
+        self.pending += 1
+        self.commit_if_due()
@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import attributed_body
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures', 'attributed_body')
+
+
+def load(name):
+    with open(os.path.join(FIXTURES, name + '.bin'), 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    attributed_body._cache.clear()
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("short", "On my way home"),                   # 1-byte length
+    ("long_81", "a long message " * 20),           # 0x81 + uint16 length
+    ("huge_82", "x" * 70000),                      # 0x82 + uint32 length
+    ("emoji", "miss you already 😘💕 café"),       # multi-byte UTF-8
+])
+def test_extract_text(name, expected):
+    assert attributed_body.extract_text(load(name)) == expected
+
+
+@pytest.mark.parametrize("name", ["truncated", "garbage"])
+def test_extract_text_rejects_bad_blobs(name):
+    assert attributed_body.extract_text(load(name)) is None
+
+
+def test_extract_text_accepts_memoryview():
+    assert attributed_body.extract_text(memoryview(load("emoji"))) == "miss you already 😘💕 café"
+
+
+def test_extract_text_empty():
+    assert attributed_body.extract_text(None) is None
+    assert attributed_body.extract_text(b"") is None
+
+
+def test_get_text_prefers_text_column():
+    assert attributed_body.get_text(1, "plain", load("short")) == "plain"
+
+
+def test_get_text_edited_message_not_stale():
+    assert attributed_body.get_text(5, None, load("short"), 0) == "On my way home"
+    # Same ROWID, new attributedBody and date_edited after an edit
+    assert attributed_body.get_text(5, None, load("emoji"), 700000000000000000) == "miss you already 😘💕 café"
+
+
+def test_get_text_cached_by_rowid_and_date_edited():
+    assert attributed_body.get_text(5, None, load("short"), 0) == "On my way home"
+    # Cache hit: the blob isn't looked at again until date_edited changes
+    assert attributed_body.get_text(5, None, load("emoji"), None) == "On my way home"
+
+
+def test_get_text_failed_decode_not_cached():
+    assert attributed_body.get_text(5, None, None) is None
+    assert attributed_body.get_text(5, None, load("truncated")) is None
+    assert attributed_body.get_text(5, None, load("short")) == "On my way home"
+    assert len(attributed_body._cache) == 1
+
+
+def test_decode_rows_batch():
+    rows = [
+        (1, None, load("short"), 0, 0),
+        (2, "typed", None, 0, 1),
+        (3, None, load("garbage"), 0, 0),
+    ]
+    assert attributed_body.decode_rows(rows) == [
+        (1, "On my way home", 0),
+        (2, "typed", 1),
+        (3, None, 0),
+    ]
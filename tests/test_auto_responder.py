@@ -0,0 +1,101 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import auto_responder
+from context_builder import estimate_tokens
+
+PERSONALITY = "Be warm, playful and supportive. " * 20
+RECENT = ["miss you already", "you looked amazing today", "cant wait to see you tonight"]
+
+
+def prompt_tokens(personality, incoming, recent):
+    return estimate_tokens(auto_responder.build_response_prompt(personality, incoming, recent))
+
+
+def test_fit_fixed_prompt_untouched_when_it_fits():
+    personality, recent = auto_responder.fit_fixed_prompt(PERSONALITY, "hey", RECENT, 1024)
+    assert personality == PERSONALITY
+    assert recent == RECENT
+
+
+def test_fit_fixed_prompt_drops_oldest_recent_first():
+    budget = prompt_tokens(PERSONALITY, "hey", RECENT[1:])
+    personality, recent = auto_responder.fit_fixed_prompt(PERSONALITY, "hey", RECENT, budget)
+    assert personality == PERSONALITY
+    assert recent == RECENT[1:]
+
+
+def test_fit_fixed_prompt_trims_personality_not_message():
+    incoming = "long day, tell you all about it later " * 10
+    budget = prompt_tokens("", incoming, []) + 20
+    personality, recent = auto_responder.fit_fixed_prompt(PERSONALITY, incoming, RECENT, budget)
+    assert recent == []
+    assert PERSONALITY.startswith(personality) and personality != PERSONALITY
+    assert prompt_tokens(personality, incoming, recent) <= budget
+
+
+def test_fit_fixed_prompt_oversized_message_kept_whole():
+    incoming = "x" * 8000
+    personality, recent = auto_responder.fit_fixed_prompt(PERSONALITY, incoming, RECENT, 100)
+    assert personality == ""
+    assert recent == []
+    assert incoming in auto_responder.build_response_prompt(personality, incoming, recent)
+
+
+NOW = 1_700_000_000
+
+
+def msg(rowid, text, minutes_ago, is_from_me=0):
+    """A get_messages_since row: (rowid, guid, text, is_from_me, unix_time, associated_type)."""
+    return (rowid, f"guid-{rowid}", text, is_from_me, NOW - minutes_ago * 60, 0)
+
+
+BACKLOG = [msg(1, "hey", 30), msg(2, "you there", 20), msg(3, "call me", 10)]
+
+
+def test_plan_replies_last():
+    replies, skipped = auto_responder.plan_replies(BACKLOG, "last", 60, NOW)
+    assert replies == [("call me", [BACKLOG[2]])]
+    assert skipped == BACKLOG[:2]
+
+
+def test_plan_replies_coalesce():
+    replies, skipped = auto_responder.plan_replies(BACKLOG, "coalesce", 60, NOW)
+    assert replies == [("hey\nyou there\ncall me", BACKLOG)]
+    assert skipped == []
+
+
+def test_plan_replies_each():
+    replies, skipped = auto_responder.plan_replies(BACKLOG, "each", 60, NOW)
+    assert replies == [(m[2], [m]) for m in BACKLOG]
+    assert skipped == []
+
+
+def test_plan_replies_skips_stale():
+    replies, skipped = auto_responder.plan_replies(BACKLOG, "each", 15, NOW)
+    assert replies == [("call me", [BACKLOG[2]])]
+    assert skipped == BACKLOG[:2]
+
+
+def test_plan_replies_all_stale():
+    assert auto_responder.plan_replies(BACKLOG, "last", 5, NOW) == ([], BACKLOG)
+
+
+def test_split_answered_by_later_outgoing():
+    messages = [msg(1, "hey", 30), msg(2, "on my way", 25, is_from_me=1), msg(3, "ok see you", 10)]
+    unanswered, answered = auto_responder.split_answered(messages)
+    assert unanswered == [messages[2]]
+    assert answered == [messages[0]]
+
+
+def test_split_answered_nothing_sent():
+    assert auto_responder.split_answered(BACKLOG) == (BACKLOG, [])
+
+
+def test_classify_message():
+    assert auto_responder.classify_message("Loved “hey”", 2000) == "tapback"
+    assert auto_responder.classify_message("  ", 0) == "empty"
+    assert auto_responder.classify_message(None, 0) == "empty"
+    assert auto_responder.classify_message("hey", 0) == "reply"
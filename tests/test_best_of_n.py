@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import best_of_n
+
+RECENT = [
+    "You Looked Amazing Today Love",
+    "cant stop thinking about you babe",
+    "miss you already, see you tonight",
+]
+
+
+def test_clean_reply_is_good_enough():
+    score = best_of_n.score_candidate("proud of you for crushing that meeting today, knew you would", RECENT, 12)
+    assert score >= best_of_n.GOOD_ENOUGH_SCORE
+
+
+def test_question_penalized():
+    assert best_of_n.score_candidate("what are you up to tonight love?", RECENT, 7) <= -best_of_n.QUESTION_PENALTY
+
+
+def test_banned_term_penalized():
+    assert best_of_n.score_candidate("haha girl you are too funny today", RECENT, 7) <= -best_of_n.BANNED_TERM_PENALTY
+
+
+def test_exact_repeat_ignores_case():
+    # A repeat of a cached reply must cost at least as much as a question
+    score = best_of_n.score_candidate("you looked amazing today love", RECENT, 5)
+    assert score <= -best_of_n.QUESTION_PENALTY
+
+
+def test_length_within_tolerance_is_free():
+    assert best_of_n.score_candidate("one two three four five six seven", [], 10) == 0.0
+
+
+def test_too_short_misses_early_exit():
+    assert best_of_n.score_candidate("ok", [], 25) < best_of_n.GOOD_ENOUGH_SCORE
+
+
+def test_zero_length_target():
+    assert best_of_n.score_candidate("hi there", [], 0) < 0
+
+
+def test_empty_candidate_never_wins():
+    assert best_of_n.score_candidate("", [], 10) == float('-inf')
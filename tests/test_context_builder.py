@@ -0,0 +1,58 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import context_builder
+from context_builder import estimate_tokens
+
+TURNS = [(100 + i, f"message number {i} about dinner plans and the weekend", i % 2) for i in range(13)]
+
+
+@pytest.fixture
+def thread(monkeypatch):
+    """Serve TURNS as the thread and a fixed summary, without chat.db or the LLM."""
+    summary = {"text": "They planned a trip to the coast and love sushi."}
+    monkeypatch.setattr(context_builder, "fetch_thread", lambda phone, limit, *args: TURNS[-limit:])
+    monkeypatch.setattr(context_builder, "refresh_summary", lambda model, url, phone, start, *args: summary["text"])
+    return summary
+
+
+def test_build_context_includes_summary_and_recent(thread):
+    context = context_builder.build_context("m", "u", "+15551234567", history_turns=12, max_tokens=1024)
+    assert context.startswith("Conversation so far: They planned")
+    assert "Recent messages:\n" in context
+    assert "Them: message number 12" in context
+    assert "message number 0 " not in context  # history_turns + 1 fetched, oldest dropped
+
+
+def test_build_context_excludes_answered_message(thread):
+    context = context_builder.build_context("m", "u", "+15551234567", exclude_rowid=112, history_turns=12)
+    assert "message number 12" not in context
+    assert "message number 0 " in context
+
+
+@pytest.mark.parametrize("max_tokens", [1, 20, 40, 80, 150, 400])
+def test_build_context_stays_within_budget(thread, max_tokens):
+    context = context_builder.build_context("m", "u", "+15551234567", max_tokens=max_tokens)
+    assert estimate_tokens(context) <= max_tokens
+
+
+def test_build_context_keeps_newest_turns(thread):
+    context = context_builder.build_context("m", "u", "+15551234567", max_tokens=80)
+    lines = context.split("Recent messages:\n")[1].split("\n")
+    assert lines[-1].endswith("message number 12 about dinner plans and the weekend")
+    assert len(lines) < 12
+
+
+def test_build_context_long_summary_capped_at_half(thread):
+    thread["text"] = "word " * 2000
+    context = context_builder.build_context("m", "u", "+15551234567", max_tokens=200)
+    assert estimate_tokens(context) <= 200
+    assert "Recent messages:\n" in context
+
+
+def test_build_context_no_budget(thread):
+    assert context_builder.build_context("m", "u", "+15551234567", max_tokens=0) == ""
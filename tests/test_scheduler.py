@@ -0,0 +1,81 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import scheduler
+
+NIGHT = ["22:00", "08:00"]
+NOW = datetime(2026, 3, 10, 12, 0).timestamp()  # Noon, outside NIGHT
+
+
+def recipient(**overrides):
+    config = {"recipients": [dict({"phone": "+15551234567"}, **overrides)]}
+    return scheduler.get_recipients(config)[0]
+
+
+def test_quiet_window_wraps_midnight_evening():
+    end = scheduler.quiet_window_end(datetime(2026, 3, 10, 23, 30), NIGHT)
+    assert end == datetime(2026, 3, 11, 8, 0)
+
+
+def test_quiet_window_wraps_midnight_early_morning():
+    end = scheduler.quiet_window_end(datetime(2026, 3, 11, 2, 15), NIGHT)
+    assert end == datetime(2026, 3, 11, 8, 0)
+
+
+def test_quiet_window_edges():
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 22, 0), NIGHT) == datetime(2026, 3, 11, 8, 0)
+    assert scheduler.quiet_window_end(datetime(2026, 3, 11, 8, 0), NIGHT) is None
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 21, 59), NIGHT) is None
+
+
+def test_quiet_window_same_day():
+    window = ["13:00", "15:00"]
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 14, 0), window) == datetime(2026, 3, 10, 15, 0)
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 16, 0), window) is None
+
+
+def test_quiet_window_hour_numbers_and_empty():
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 23, 0), [22.5, 7]) == datetime(2026, 3, 11, 7, 0)
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 23, 0), None) is None
+    assert scheduler.quiet_window_end(datetime(2026, 3, 10, 23, 0), ["08:00", "08:00"]) is None
+
+
+def test_build_schedule_keeps_future_send():
+    r = recipient()
+    heap = scheduler.build_schedule([r], {r['phone']: NOW + 600}, NOW)
+    assert heap == [(NOW + 600, r['phone'])]
+
+
+def test_build_schedule_catches_up_recent_miss():
+    r = recipient(catch_up="send", catch_up_grace_minutes=60)
+    heap = scheduler.build_schedule([r], {r['phone']: NOW - 30 * 60}, NOW)
+    assert heap == [(NOW, r['phone'])]
+
+
+def test_build_schedule_skips_old_miss():
+    r = recipient(catch_up="send", catch_up_grace_minutes=60, min_hours=1, max_hours=2)
+    [(send_at, _)] = scheduler.build_schedule([r], {r['phone']: NOW - 3 * 3600}, NOW)
+    assert NOW + 3600 <= send_at <= NOW + 2 * 3600
+
+
+def test_build_schedule_skip_policy_reschedules():
+    r = recipient(catch_up="skip", min_hours=1, max_hours=2)
+    [(send_at, _)] = scheduler.build_schedule([r], {r['phone']: NOW - 60}, NOW)
+    assert NOW + 3600 <= send_at <= NOW + 2 * 3600
+
+
+def test_build_schedule_catch_up_waits_out_quiet_hours():
+    night = datetime(2026, 3, 10, 23, 0).timestamp()
+    r = recipient(catch_up="send", quiet_hours=NIGHT)
+    [(send_at, _)] = scheduler.build_schedule([r], {r['phone']: night - 10 * 60}, night)
+    morning = datetime(2026, 3, 11, 8, 0)
+    assert morning.timestamp() <= send_at <= (morning + timedelta(minutes=30)).timestamp()
+
+
+def test_build_schedule_orders_recipients():
+    a, b = recipient(phone="+15550000001"), recipient(phone="+15550000002")
+    heap = scheduler.build_schedule([a, b], {a['phone']: NOW + 900, b['phone']: NOW + 60}, NOW)
+    assert heap[0] == (NOW + 60, b['phone'])